@@ -1,235 +1,310 @@
 import streamlit as st
-import xml.etree.ElementTree as ET
+import hashlib
 import pandas as pd
+from enum import Enum
 from io import BytesIO
+from lxml import etree
 
 st.set_page_config(page_title="ODM File Processor", page_icon="📊", layout="wide")
 
 MONITORING_COLUMNS = ['SDV', 'Medical Review', 'Data Review']
 IGNORED_SITE = 'REDCap Cloud Demo'
 
+ODM_NS = 'http://www.cdisc.org/ns/odm/v1.3'
+REDCAP_NS = 'https://www.redcapcloud.com/ns/odm_ext_v132/v10'
+
+PARSER_OPTIONS = {'huge_tree': True, 'collect_ids': False, 'remove_blank_text': True, 'resolve_entities': False}
+
+ODM_TAGS = ('MetaDataVersion', 'FormDef', 'FormRef', 'StudyEventDef',
+            'SubjectData', 'ClinicalData', 'AdminData', 'ReferenceData')
+REDCAP_ATTRS = ('UniqueEventName', 'AllowManualSchedule', 'DynamicEvent', 'CreatedByRule',
+                'DefaultVersion', 'Repeating', 'DynamicForm')
+
+EVENT_RECORD_COLUMNS = ['Unique Event Name', 'Name', 'Manual Scheduling', 'Repeating', 'DynamicEvent', 'CreatedByRule']
+INSTRUMENT_COLUMNS = ['Event', 'Instrument Name', 'Version', 'Site', 'Repeating', 'Dynamic', 'Required'] + MONITORING_COLUMNS
+
+FLAG_COLUMNS = ['Dynamic/Created by Rule'] + MONITORING_COLUMNS
+
+CAT_YN = pd.CategoricalDtype(['Y', 'N'])
+EVENT_DTYPES = {'Manual Scheduling': 'category', 'Repeating': 'category', 'Dynamic/Created by Rule': 'uint8'}
+INSTRUMENT_DTYPES = {'Event': 'category', 'Site': 'category', 'Repeating': 'category', 'Dynamic': 'category',
+                     'Required': 'category', **{col: 'uint8' for col in MONITORING_COLUMNS}}
+
+TRUE_VALUES = frozenset(['yes', 'true', '1', 'y'])
+FALSE_VALUES = frozenset(['no', 'false', '0', 'n'])
+DYNAMIC_VALUES = TRUE_VALUES | frozenset(['dynamic', 'created by rule'])
+
+class NamespaceStyle(Enum):
+    QUALIFIED = 'qualified'
+    UNQUALIFIED = 'unqualified'
+
 def to_yes_no(value):
-    if value is None:
+    if not value:
         return 'N'
-    value_str = str(value).strip().lower()
-    if value_str in ['yes', 'true', '1', 'y']:
+    value_str = value.strip().lower()
+    if value_str in TRUE_VALUES:
         return 'Y'
-    elif value_str in ['no', 'false', '0', 'n']:
+    if value_str in FALSE_VALUES or not value_str:
         return 'N'
-    else:
-        return 'N' if not value_str else value_str.upper()
+    return value_str.upper()
 
 def is_true_value(value):
-    if value is None:
-        return False
-    value_str = str(value).strip().lower()
-    return value_str in ['yes', 'true', '1', 'y', 'dynamic', 'created by rule']
+    return bool(value) and value.strip().lower() in DYNAMIC_VALUES
+
+def map_unique(series, func):
+    return series.map({value: func(value) for value in series.unique()})
+
+def yes_no_column(series):
+    return map_unique(series, to_yes_no)
 
 def get_namespace_map(root):
-    odm_ns = 'http://www.cdisc.org/ns/odm/v1.3'
-    redcap_ns = 'https://www.redcapcloud.com/ns/odm_ext_v132/v10'
+    odm_ns = ODM_NS
+    redcap_ns = REDCAP_NS
 
     if '}' in root.tag:
         ns_uri = root.tag.split('}')[0][1:]
         if 'odm' in ns_uri.lower():
             odm_ns = ns_uri
 
-    for attr, value in root.attrib.items():
-        if 'xmlns' in attr:
-            if 'odm' in value.lower() and 'cdisc' in value.lower():
-                odm_ns = value
-            if 'redcap' in value.lower():
-                redcap_ns = value
+    for value in root.nsmap.values():
+        if 'odm' in value.lower() and 'cdisc' in value.lower():
+            odm_ns = value
+        if 'redcap' in value.lower():
+            redcap_ns = value
 
     return {'odm': odm_ns, 'REDCap': redcap_ns}
 
-def find_elements_once(root, tag_name, namespaces):
-    ns_uri = namespaces.get('odm', 'http://www.cdisc.org/ns/odm/v1.3')
-    elements = root.findall(f'.//{{{ns_uri}}}{tag_name}')
-    if elements:
-        return elements
-    elements = root.findall(f'.//odm:{tag_name}', namespaces)
-    if elements:
-        return elements
-    return root.findall(f'.//{tag_name}')
-
-def get_redcap_attr(element, attr_name, namespaces):
-    ns_uri = namespaces.get('REDCap', 'https://www.redcapcloud.com/ns/odm_ext_v132/v10')
-    value = element.get(f'{{{ns_uri}}}{attr_name}', '')
-    if value:
-        return value
-    return element.get(attr_name, '')
-
-def extract_metadata_versions(root, namespaces):
-    metadata_versions = find_elements_once(root, 'MetaDataVersion', namespaces)
-    if not metadata_versions:
-        return {}
-    
-    site_forms_map = {}
-    for mv in metadata_versions:
-        mv_oid = mv.get('OID', '')
-        site_name = mv.get('Name', '')
-        if not site_name:
-            site_name = mv_oid
-        if site_name == IGNORED_SITE:
-            continue
-        
-        form_oids = set()
-        form_defs = mv.findall(f'.//{{{namespaces.get("odm", "http://www.cdisc.org/ns/odm/v1.3")}}}FormDef')
-        if not form_defs:
-            form_defs = mv.findall('.//odm:FormDef', namespaces)
-        if not form_defs:
-            form_defs = mv.findall('.//FormDef')
-        for form in form_defs:
-            form_oid = form.get('OID', '')
-            if form_oid:
-                form_oids.add(form_oid)
-        
-        form_refs = mv.findall(f'.//{{{namespaces.get("odm", "http://www.cdisc.org/ns/odm/v1.3")}}}FormRef')
-        if not form_refs:
-            form_refs = mv.findall('.//odm:FormRef', namespaces)
-        if not form_refs:
-            form_refs = mv.findall('.//FormRef')
-        for form_ref in form_refs:
-            form_oid = form_ref.get('FormOID', '')
-            if form_oid:
-                form_oids.add(form_oid)
-        
-        if site_name in site_forms_map:
-            site_forms_map[site_name]['forms'].update(form_oids)
-        else:
-            site_forms_map[site_name] = {'oid': mv_oid, 'forms': form_oids}
-    return site_forms_map
-
-def extract_event_definitions(root, namespaces):
-    study_event_defs = find_elements_once(root, 'StudyEventDef', namespaces)
-    if not study_event_defs:
-        return pd.DataFrame()
-
-    event_definitions = []
-    seen_oids = set()
-    for event in study_event_defs:
-        oid = event.get('OID', '')
-        if not oid or oid in seen_oids:
-            continue
-        seen_oids.add(oid)
-
-        dynamic_event = get_redcap_attr(event, 'DynamicEvent', namespaces)
-        created_by_rule = get_redcap_attr(event, 'CreatedByRule', namespaces)
-        dynamic_created_by_rule = 'Y' if (is_true_value(dynamic_event) or is_true_value(created_by_rule)) else 'N'
-
-        event_info = {
-            'Unique Event Name': get_redcap_attr(event, 'UniqueEventName', namespaces),
-            'Name': event.get('Name', ''),
-            'Manual Scheduling': to_yes_no(get_redcap_attr(event, 'AllowManualSchedule', namespaces)),
-            'Repeating': to_yes_no(event.get('Repeating', '')),
-            'Dynamic/Created by Rule': dynamic_created_by_rule
-        }
-        event_definitions.append(event_info)
-    return pd.DataFrame(event_definitions)
-
-def extract_event_instruments(root, namespaces):
-    study_event_defs = find_elements_once(root, 'StudyEventDef', namespaces)
-    form_defs = find_elements_once(root, 'FormDef', namespaces)
-    if not study_event_defs:
+def detect_ns_style(root):
+    if root.tag.startswith('{'):
+        return NamespaceStyle.QUALIFIED
+    return NamespaceStyle.UNQUALIFIED
+
+def build_tag_map(namespaces, ns_style):
+    if ns_style is NamespaceStyle.UNQUALIFIED:
+        return {name: name for name in ODM_TAGS}
+    ns_uri = namespaces.get('odm', ODM_NS)
+    return {f'{{{ns_uri}}}{name}': name for name in ODM_TAGS}
+
+def build_redcap_attr_map(namespaces):
+    ns_uri = namespaces.get('REDCap', REDCAP_NS)
+    return {name: f'{{{ns_uri}}}{name}' for name in REDCAP_ATTRS}
+
+def build_monitoring_tags(namespaces, ns_style):
+    ns_uri = namespaces.get('REDCap', REDCAP_NS)
+    if ns_style is NamespaceStyle.UNQUALIFIED:
+        return frozenset([f'{{{ns_uri}}}Monitoring', 'Monitoring'])
+    return frozenset([f'{{{ns_uri}}}Monitoring'])
+
+def read_root_element(xml_content):
+    for _, root in etree.iterparse(BytesIO(xml_content), events=('start',), **PARSER_OPTIONS):
+        return root
+
+def release_element(elem):
+    elem.clear(keep_tail=True)
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+def get_redcap_attr(element, attr_name, rc_attrs):
+    return element.get(rc_attrs[attr_name]) or element.get(attr_name, '')
+
+def extract_metadata_version(mv, form_oids, site_forms_map):
+    mv_oid = mv.get('OID', '')
+    site_name = mv.get('Name', '')
+    if not site_name:
+        site_name = mv_oid
+    if site_name == IGNORED_SITE:
+        return
+
+    if site_name in site_forms_map:
+        site_forms_map[site_name]['forms'].update(form_oids)
+    else:
+        site_forms_map[site_name] = {'oid': mv_oid, 'forms': set(form_oids)}
+
+def extract_event_definition(event, rc_attrs):
+    return {
+        'Unique Event Name': get_redcap_attr(event, 'UniqueEventName', rc_attrs),
+        'Name': event.get('Name', ''),
+        'Manual Scheduling': get_redcap_attr(event, 'AllowManualSchedule', rc_attrs),
+        'Repeating': event.get('Repeating', ''),
+        'DynamicEvent': get_redcap_attr(event, 'DynamicEvent', rc_attrs),
+        'CreatedByRule': get_redcap_attr(event, 'CreatedByRule', rc_attrs)
+    }
+
+def build_event_definitions(event_definitions):
+    if not event_definitions:
         return pd.DataFrame()
-
-    site_forms_map = extract_metadata_versions(root, namespaces)
-    all_valid_sites = set(site_forms_map.keys())
-
-    form_oid_to_name = {}
-    seen_form_oids = set()
-    for form in form_defs:
-        oid = form.get('OID', '')
-        if oid and oid not in seen_form_oids:
-            seen_form_oids.add(oid)
-            form_oid_to_name[oid] = form.get('Name', '')
+    df = pd.DataFrame.from_records(event_definitions, columns=EVENT_RECORD_COLUMNS)
+    df['Manual Scheduling'] = yes_no_column(df['Manual Scheduling'])
+    df['Repeating'] = yes_no_column(df['Repeating'])
+    is_dynamic = (map_unique(df.pop('DynamicEvent'), is_true_value)
+                  | map_unique(df.pop('CreatedByRule'), is_true_value))
+    df['Dynamic/Created by Rule'] = is_dynamic
+    return df.astype(EVENT_DTYPES)
+
+def format_flag_columns(df):
+    df = df.copy()
+    for col in FLAG_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].map({1: 'Y', 0: 'N'}).astype(CAT_YN)
+    return df
+
+def extract_form_ref(form_ref, event_name, rc_attrs, monitoring_tags):
+    monitoring_types_present = set()
+    for monitoring_elem in form_ref.iterchildren(*monitoring_tags):
+        mtype = monitoring_elem.get('Type', '')
+        if mtype:
+            monitoring_types_present.add(mtype)
+
+    record = {
+        'Event': event_name,
+        'FormOID': form_ref.get('FormOID', ''),
+        'Version': get_redcap_attr(form_ref, 'DefaultVersion', rc_attrs),
+        'Repeating': get_redcap_attr(form_ref, 'Repeating', rc_attrs),
+        'Dynamic': get_redcap_attr(form_ref, 'DynamicForm', rc_attrs),
+        'Required': form_ref.get('Mandatory', '')
+    }
+    for col in MONITORING_COLUMNS:
+        record[col] = 1 if col in monitoring_types_present else 0
+    return record
+
+def build_form_site_index(site_forms_map):
+    form_to_sites = {}
+    for site_name, info in site_forms_map.items():
+        for form_oid in info['forms']:
+            form_to_sites.setdefault(form_oid, set()).add(site_name)
+    return form_to_sites
+
+def build_event_instruments(form_ref_records, form_oid_to_name, site_forms_map):
+    if not form_ref_records:
+        return pd.DataFrame(columns=INSTRUMENT_COLUMNS).astype(INSTRUMENT_DTYPES)
+
+    form_to_sites = build_form_site_index(site_forms_map)
+    site_count = len(site_forms_map)
+    site_display_cache = {}
 
     event_instruments = []
-    seen_event_form_combos = set()
-
-    for event in study_event_defs:
-        event_oid = event.get('OID', '')
-        event_name = event.get('Name', '')
-
-        form_refs = []
-        redcap_ns = namespaces.get('REDCap')
-        if namespaces.get('odm'):
-            form_refs = event.findall(f'odm:FormRef', namespaces)
-        if not form_refs and redcap_ns:
-            form_refs = event.findall(f'FormRef')
-        if not form_refs:
-            for child in event:
-                if 'FormRef' in child.tag or child.tag.endswith('FormRef'):
-                    form_refs.append(child)
-
-        for form_ref in form_refs:
-            form_oid = form_ref.get('FormOID', '')
-            combo_key = (event_oid, form_oid)
-            if not form_oid or combo_key in seen_event_form_combos:
-                continue
-            seen_event_form_combos.add(combo_key)
-
-            form_sites = set()
-            if site_forms_map:
-                for site_name, info in site_forms_map.items():
-                    if form_oid in info['forms']:
-                        form_sites.add(site_name)
-            
+    for record in form_ref_records:
+        form_oid = record.pop('FormOID')
+
+        site_display = site_display_cache.get(form_oid)
+        if site_display is None:
+            form_sites = form_to_sites.get(form_oid)
             if not form_sites:
                 site_display = 'Unknown Site'
-            elif form_sites == all_valid_sites:
+            elif len(form_sites) == site_count:
                 site_display = 'All sites'
             else:
                 site_display = ', '.join(sorted(form_sites))
+            site_display_cache[form_oid] = site_display
+
+        record['Instrument Name'] = form_oid_to_name.get(form_oid, '')
+        record['Site'] = site_display
+        event_instruments.append(record)
 
-            monitoring_types_present = set()
-            if redcap_ns:
-                monitoring_elems = form_ref.findall(f'.//{{{redcap_ns}}}Monitoring')
-                if not monitoring_elems:
-                    monitoring_elems = form_ref.findall('.//REDCap:Monitoring', namespaces)
-                if not monitoring_elems:
-                    for child in form_ref:
-                        if 'Monitoring' in child.tag:
-                            monitoring_elems.append(child)
-                for monitoring_elem in monitoring_elems:
-                    mtype = monitoring_elem.get('Type', '')
-                    if mtype:
-                        monitoring_types_present.add(mtype)
-
-            record = {
-                'Event': event_name,
-                'Instrument Name': form_oid_to_name.get(form_oid, ''),
-                'Version': get_redcap_attr(form_ref, 'DefaultVersion', namespaces),
-                'Site': site_display,
-                'Repeating': to_yes_no(get_redcap_attr(form_ref, 'Repeating', namespaces)),
-                'Dynamic': to_yes_no(get_redcap_attr(form_ref, 'DynamicForm', namespaces)),
-                'Required': to_yes_no(form_ref.get('Mandatory', ''))
-            }
-            for col in MONITORING_COLUMNS:
-                record[col] = 'Y' if col in monitoring_types_present else 'N'
-            event_instruments.append(record)
-
-    df = pd.DataFrame(event_instruments)
-    if df.empty:
-        columns = ['Event', 'Instrument Name', 'Version', 'Site', 'Repeating', 'Dynamic', 'Required'] + MONITORING_COLUMNS
-        return pd.DataFrame(columns=columns)
-    final_cols = ['Event', 'Instrument Name', 'Version', 'Site', 'Repeating', 'Dynamic', 'Required'] + MONITORING_COLUMNS
-    final_cols = [c for c in final_cols if c in df.columns]
-    return df[final_cols]
+    df = pd.DataFrame.from_records(event_instruments, columns=INSTRUMENT_COLUMNS)
+    for col in ['Repeating', 'Dynamic', 'Required']:
+        df[col] = yes_no_column(df[col])
+    return df.astype(INSTRUMENT_DTYPES)
+
+def parse_odm(xml_content):
+    root = read_root_element(xml_content)
+    namespaces = get_namespace_map(root)
+    ns_style = detect_ns_style(root)
+    tag_map = build_tag_map(namespaces, ns_style)
+    rc_attrs = build_redcap_attr_map(namespaces)
+    monitoring_tags = build_monitoring_tags(namespaces, ns_style)
+
+    event_definitions = []
+    form_ref_records = []
+    form_oid_to_name = {}
+    site_forms_map = {}
+    mv_form_oids = set()
+    seen_event_oids = set()
+    seen_forms_by_event = {}
+    found_events = False
+    current_event = None
+    event_name = ''
+    event_form_oids = set()
+
+    context = etree.iterparse(BytesIO(xml_content), events=('end',), tag=list(tag_map),
+                              **PARSER_OPTIONS)
+    for _, elem in context:
+        kind = tag_map[elem.tag]
+
+        if kind == 'FormRef':
+            form_oid = elem.get('FormOID', '')
+            if not form_oid:
+                continue
+            mv_form_oids.add(form_oid)
+            event = elem.getparent()
+            if event is not current_event:
+                if event is None or tag_map.get(event.tag) != 'StudyEventDef':
+                    continue
+                current_event = event
+                event_name = event.get('Name', '')
+                event_form_oids = seen_forms_by_event.setdefault(event.get('OID', ''), set())
+            if form_oid in event_form_oids:
+                continue
+            event_form_oids.add(form_oid)
+            form_ref_records.append(extract_form_ref(elem, event_name, rc_attrs, monitoring_tags))
+
+        elif kind == 'StudyEventDef':
+            found_events = True
+            oid = elem.get('OID', '')
+            if oid and oid not in seen_event_oids:
+                seen_event_oids.add(oid)
+                event_definitions.append(extract_event_definition(elem, rc_attrs))
+            current_event = None
+            release_element(elem)
+
+        elif kind == 'FormDef':
+            oid = elem.get('OID', '')
+            if oid:
+                mv_form_oids.add(oid)
+                if oid not in form_oid_to_name:
+                    form_oid_to_name[oid] = elem.get('Name', '')
+            release_element(elem)
+
+        elif kind == 'MetaDataVersion':
+            extract_metadata_version(elem, mv_form_oids, site_forms_map)
+            mv_form_oids = set()
+            release_element(elem)
+
+        else:
+            release_element(elem)
+
+    if not found_events:
+        return pd.DataFrame(), pd.DataFrame()
+
+    df_events = build_event_definitions(event_definitions)
+    df_instruments = build_event_instruments(form_ref_records, form_oid_to_name, site_forms_map)
+    return df_events, df_instruments
 
 def process_odm_content(xml_content):
     try:
-        root = ET.fromstring(xml_content)
-        namespaces = get_namespace_map(root)
-        df_events = extract_event_definitions(root, namespaces)
-        df_instruments = extract_event_instruments(root, namespaces)
+        df_events, df_instruments = parse_odm(xml_content)
         return df_events, df_instruments, None
-    except ET.ParseError as e:
+    except etree.XMLSyntaxError as e:
         return None, None, f"XML Parse Error: {str(e)}"
     except Exception as e:
         return None, None, f"Error: {str(e)}"
 
+@st.cache_data(show_spinner=False)
+def load_odm_file(content_digest, _xml_content):
+    return process_odm_content(_xml_content)
+
+@st.cache_data(show_spinner=False)
+def build_excel_file(content_digest, _df_events, _df_instruments):
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        if not _df_events.empty:
+            _df_events.to_excel(writer, sheet_name='Event Definitions', index=False)
+        if not _df_instruments.empty:
+            _df_instruments.to_excel(writer, sheet_name='Event Instruments', index=False)
+    return output.getvalue()
+
 # ============================================================================
 # STREAMLIT UI
 # ============================================================================
@@ -241,15 +316,18 @@ uploaded_file = st.file_uploader("Choose an ODM XML file", type=['xml'])
 
 if uploaded_file is not None:
     st.info(f"**File:** {uploaded_file.name} ({uploaded_file.size} bytes)")
-    xml_content = uploaded_file.read()
+    xml_content = uploaded_file.getvalue()
+    content_digest = hashlib.blake2b(xml_content).hexdigest()
     
     with st.spinner("Processing ODM file..."):
-        df_events, df_instruments, error = process_odm_content(xml_content)
+        df_events, df_instruments, error = load_odm_file(content_digest, xml_content)
     
     if error:
         st.error(error)
     else:
         st.success("✓ File processed successfully!")
+        df_events = format_flag_columns(df_events)
+        df_instruments = format_flag_columns(df_instruments)
         
         tab1, tab2 = st.tabs(["Event Definitions", "Event Instruments"])
         
@@ -268,17 +346,11 @@ if uploaded_file is not None:
                 st.info("No event instruments found.")
         
         output_filename = uploaded_file.name.replace('.xml', '_events.xlsx')
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            if not df_events.empty:
-                df_events.to_excel(writer, sheet_name='Event Definitions', index=False)
-            if not df_instruments.empty:
-                df_instruments.to_excel(writer, sheet_name='Event Instruments', index=False)
-        output.seek(0)
+        excel_data = build_excel_file(content_digest, df_events, df_instruments)
         
         st.download_button(
             label="📥 Download Excel File",
-            data=output,
+            data=excel_data,
             file_name=output_filename,
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )